@@ -14,7 +14,10 @@ class EmbeddingExplainerTF(PathExplainerTF):
     to reduce dimensionality.
     """
 
-    def __init__(self, model, embedding_axis=2):
+    accumulation_accepts_masks = True
+
+    def __init__(self, model, embedding_axis=2, use_xla=True,
+                 compute_dtype=None, strategy=None):
         """
         Initialize the TF explainer class. This class
         will handle both the eager and the
@@ -25,14 +28,15 @@ class EmbeddingExplainerTF(PathExplainerTF):
                    A tuple (input_tensor, output_tensor) otherwise.
             embedding_dimension: The axis corresponding to the embeddings.
                                  Usually this is 2.
+            use_xla: Set to True to compile the gradient computation with XLA.
+            compute_dtype: The dtype to run the model in. See PathExplainerTF.
+            strategy: An optional tf.distribute.Strategy. See PathExplainerTF.
         """
-        self.model = model
-        self.eager_mode = False
+        super().__init__(model,
+                         use_xla=use_xla,
+                         compute_dtype=compute_dtype,
+                         strategy=strategy)
         self.embedding_axis = embedding_axis
-        try:
-            self.eager_mode = tf.executing_eagerly()
-        except AttributeError:
-            pass
 
     def accumulation_function(self,
                               batch_input,
@@ -40,49 +44,54 @@ class EmbeddingExplainerTF(PathExplainerTF):
                               batch_alphas,
                               output_index=None,
                               second_order=False,
-                              interaction_index=None):
+                              interaction_index=None,
+                              sample_weights=None):
         """
         A function that computes the logic of combining gradients and
         the difference from reference. This function is meant to
         be overloaded in the case of custom gradient logic. See PathExplainerTF
         for a description of the input.
         """
-        if not second_order:
-            batch_difference = batch_input - batch_baseline
-            batch_interpolated = batch_alphas * batch_input + \
-                                 (1.0 - batch_alphas) * batch_baseline
-
-            with tf.GradientTape() as tape:
-                tape.watch(batch_interpolated)
+        # A non-negative embedding axis, so that a negative
+        # self.embedding_axis can be offset like a positive one.
+        embedding_axis = self.embedding_axis % len(batch_input.shape)
 
-                batch_predictions = self.model(batch_interpolated)
-                if output_index is not None:
-                    batch_predictions = batch_predictions[:, output_index]
-            batch_gradients = tape.gradient(batch_predictions, batch_interpolated)
-            batch_attributions = batch_gradients * batch_difference
+        if not second_order:
+            batch_attributions = super().accumulation_function(batch_input,
+                                                               batch_baseline,
+                                                               batch_alphas,
+                                                               output_index=output_index,
+                                                               sample_weights=sample_weights)
 
             ################################
             # This line is the only difference
             # for attributions. We sum over the embedding dimension.
-            batch_attributions = tf.reduce_sum(batch_attributions, axis=self.embedding_axis)
+            # The axis is counted from the end because the attributions
+            # may have an extra output axis after the batch axis, and
+            # may have been summed over the samples.
+            batch_attributions = tf.reduce_sum(batch_attributions,
+                                               axis=embedding_axis - len(batch_input.shape))
             ################################
 
             return batch_attributions
 
         batch_alpha, batch_beta = batch_alphas
         batch_difference = batch_input - batch_baseline
-        batch_interpolated_beta = batch_beta * batch_input + (1.0 - batch_beta) * batch_baseline
+        batch_interpolated_beta = batch_baseline + batch_beta * batch_difference
 
         with tf.GradientTape() as second_order_tape:
             second_order_tape.watch(batch_interpolated_beta)
 
             batch_difference_beta = batch_interpolated_beta - batch_baseline
-            batch_interpolated_alpha = batch_alpha * batch_interpolated_beta + (1.0 - batch_alpha) * batch_baseline
+            batch_interpolated_alpha = batch_baseline + batch_alpha * batch_difference_beta
             with tf.GradientTape() as first_order_tape:
                 first_order_tape.watch(batch_interpolated_alpha)
 
-                batch_predictions = self.model(batch_interpolated_alpha)
-                if output_index is not None:
+                batch_predictions = self._call_model(batch_interpolated_alpha, batch_input)
+                if tf.is_tensor(output_index):
+                    batch_predictions = tf.reduce_sum(batch_predictions * output_index,
+                                                      axis=-1)
+                elif output_index is not None:
                     batch_predictions = batch_predictions[:, output_index]
 
             batch_gradients = first_order_tape.gradient(batch_predictions, batch_interpolated_alpha)
@@ -93,7 +102,7 @@ class EmbeddingExplainerTF(PathExplainerTF):
             else:
                 ################################
                 # The first of two modifications for interactions.
-                batch_gradients = tf.reduce_sum(batch_gradients, axis=self.embedding_axis)
+                batch_gradients = tf.reduce_sum(batch_gradients, axis=embedding_axis)
                 ################################
 
         if interaction_index is not None:
@@ -114,10 +123,10 @@ class EmbeddingExplainerTF(PathExplainerTF):
         ################################
         # The second of two modifications for interactions.
         if interaction_index is None:
-            # This axis computation is really len(input.shape) - 1 + self.embedding_axis - 1
+            # This axis computation is really len(input.shape) - 1 + embedding_axis - 1
             # The -1's are because we squashed a batch dimension and the first embedding dimension.
 
-            hessian_embedding_axis = len(batch_input.shape) + self.embedding_axis - 2
+            hessian_embedding_axis = len(batch_input.shape) + embedding_axis - 2
             batch_interactions = tf.reduce_sum(batch_interactions, axis=hessian_embedding_axis)
         ################################
 
@@ -143,13 +152,17 @@ class EmbeddingExplainerTF(PathExplainerTF):
             shape_tuple = [inputs.shape[0], inputs.shape[1], inputs.shape[1]]
             shape_tuple = tuple(shape_tuple)
 
+        # Match the dtype of the gradients so that writing
+        # into the array doesn't need a cast.
+        dtype = tf.as_dtype(inputs.dtype).as_numpy_dtype
+
         if is_multi_output and output_indices is None:
             num_classes = test_output.shape[-1]
-            attributions = np.zeros((num_classes,) + shape_tuple)
+            attributions = np.zeros((num_classes,) + shape_tuple, dtype=dtype)
         elif not is_multi_output and output_indices is not None:
             raise ValueError('Provided output_indices but ' + \
                              'model is not multi output!')
         else:
-            attributions = np.zeros(shape_tuple)
+            attributions = np.zeros(shape_tuple, dtype=dtype)
 
         return attributions, is_multi_output, num_classes
@@ -4,6 +4,7 @@ used to get feature-level importances of TensorFlow
 gradient-based models.
 """
 
+import warnings
 import tensorflow as tf
 import numpy as np
 from tqdm import tqdm
@@ -14,7 +15,22 @@ class PathExplainerTF(Explainer):
     Explains a model using path attributions from the given baseline.
     """
 
-    def __init__(self, model, pass_original_input=False):
+    # Defaults for subclasses that set their own attributes
+    # rather than calling PathExplainerTF.__init__.
+    pass_original_input = False
+    use_xla = False
+    compute_dtype = None
+    strategy = None
+    backend = 'tf'
+
+    # Whether accumulation_function takes one-hot output masks and
+    # sample_weights. A subclass that overrides accumulation_function
+    # is passed integer output indices unless it sets this to True in
+    # its own class body. See accumulation_function.
+    accumulation_accepts_masks = True
+
+    def __init__(self, model, pass_original_input=False, use_xla=None,
+                 compute_dtype=None, strategy=None, backend='tf'):
         """
         Initialize the TF explainer class. This class
         will handle both the eager and the
@@ -30,27 +46,255 @@ class PathExplainerTF(Explainer):
                                  original_input=batch_input, meaning
                                  your mode will need to accept original_input
                                  as an argument.
+            use_xla: Set to True to compile the gradient computation with XLA.
+                     If the model contains operations that XLA cannot compile,
+                     the explainer warns and falls back to a regular tf.function.
+                     Defaults to True with the tf backend and False with
+                     the numpy backend.
+            compute_dtype: If not None, e.g. 'bfloat16' or 'float16', the model
+                           is called on inputs cast to this dtype and its
+                           predictions are cast back to the input dtype, so that
+                           the forward and backward passes run at reduced precision
+                           while the attributions are accumulated at full precision.
+                           Use this with a model built under the matching
+                           tf.keras.mixed_precision policy.
+            strategy: An optional tf.distribute.Strategy, e.g.
+                      tf.distribute.MirroredStrategy(). If given, batches of
+                      inputs are split across its replicas when computing
+                      attributions. The model should have been created
+                      under strategy.scope() so that its variables
+                      are mirrored on every replica.
+            backend: One of 'tf' or 'numpy'. With 'numpy', the weights of
+                     the model are read once here and attributions are computed
+                     with batched NumPy forward and backward passes, which
+                     avoids the per-call overhead of TensorFlow for very small
+                     models. This is only supported for models whose layers are
+                     Dense layers with linear, relu, tanh, sigmoid or softmax
+                     activations (plus Activation, Dropout and InputLayer layers),
+                     stacked in a tf.keras.Sequential model or a functional model
+                     that calls each layer once, one after another, on inputs
+                     of shape (batch_size, num_features).
+                     It can't be combined with pass_original_input, use_xla,
+                     compute_dtype, strategy or an overridden
+                     accumulation_function. Interactions always use
+                     TensorFlow.
         """
+        if use_xla is None:
+            use_xla = backend == 'tf'
+
         self.model = model
         self.pass_original_input = pass_original_input
+        self.use_xla = use_xla
+        self.compute_dtype = compute_dtype
+        self.strategy = strategy
         self.eager_mode = False
+        self._grad_steps = {}
+        self._interaction_steps = {}
+
+        if backend not in ['tf', 'numpy']:
+            raise ValueError('Unrecognized backend: {}'.format(backend))
+        self.backend = backend
+        self._dense_layers = None
+        if backend == 'numpy':
+            unsupported_options = [('pass_original_input', pass_original_input),
+                                   ('use_xla', use_xla),
+                                   ('compute_dtype', compute_dtype is not None),
+                                   ('strategy', strategy is not None)]
+            for option_name, is_set in unsupported_options:
+                if is_set:
+                    raise ValueError('The numpy backend does not support ' + \
+                                     '{}!'.format(option_name))
+            if type(self).accumulation_function is not PathExplainerTF.accumulation_function:
+                raise ValueError('The numpy backend does not support ' + \
+                                 'an overridden accumulation_function!')
+            self._dense_layers = self._extract_dense_layers()
+
         try:
             self.eager_mode = tf.executing_eagerly()
         except AttributeError:
             pass
 
+    def _is_layer_chain(self):
+        """
+        Internal helper function that checks whether self.model
+        runs its layers one after another in the order of
+        self.model.layers. This holds for a tf.keras.Sequential model,
+        and for a functional model with a single input and output
+        in which every layer is called once on the output of
+        the layer before it. The layers of a subclassed model say
+        nothing about its call, so those are rejected.
+        """
+        if type(self.model) is tf.keras.Sequential:
+            return True
+        if type(self.model).__name__ != 'Functional':
+            return False
+        if len(self.model.inputs) != 1 or len(self.model.outputs) != 1:
+            return False
+
+        previous_output = self.model.inputs[0]
+        for layer in self.model.layers:
+            if isinstance(layer, tf.keras.layers.InputLayer):
+                continue
+            if len(getattr(layer, '_inbound_nodes', [])) != 1:
+                return False
+            try:
+                layer_input = layer.input
+            except (AttributeError, ValueError):
+                return False
+            if layer_input is not previous_output:
+                return False
+            previous_output = layer.output
+        return previous_output is self.model.outputs[0]
+
+    def _extract_dense_layers(self):
+        """
+        Internal helper function that reads the weights of a
+        model made only of Dense layers, for use by the numpy backend.
+
+        Returns:
+            A list of (kernel, bias, activation) tuples, one per layer,
+            where kernel and bias are None for layers that only apply
+            an activation.
+        """
+        if not self._is_layer_chain():
+            raise ValueError('The numpy backend only supports Sequential ' + \
+                             'models, or functional models whose layers ' + \
+                             'are each called once, one after another!')
+
+        supported_activations = ['linear', 'relu', 'tanh', 'sigmoid', 'softmax']
+        dense_layers = []
+        for layer in self.model.layers:
+            if isinstance(layer, (tf.keras.layers.InputLayer,
+                                  tf.keras.layers.Dropout)):
+                continue
+            if not isinstance(layer, (tf.keras.layers.Dense,
+                                      tf.keras.layers.Activation)):
+                raise ValueError('The numpy backend does not support ' + \
+                                 'layers of type {}!'.format(type(layer).__name__))
+
+            activation = getattr(layer.activation, '__name__', None)
+            if activation not in supported_activations:
+                raise ValueError('The numpy backend does not support ' + \
+                                 'the activation {}!'.format(activation))
+
+            kernel = None
+            bias = None
+            if isinstance(layer, tf.keras.layers.Dense):
+                layer_weights = layer.get_weights()
+                kernel = layer_weights[0]
+                bias = layer_weights[1] if layer.use_bias else 0.0
+            dense_layers.append((kernel, bias, activation))
+
+        if not any(kernel is not None for kernel, _, _ in dense_layers):
+            raise ValueError('The numpy backend requires a model ' + \
+                             'made of Dense layers!')
+        return dense_layers
+
+    def _dense_gradients(self, batch_interpolated, batch_masks):
+        """
+        Internal helper function that computes the gradients of the
+        model with respect to its input using the weights read by
+        self._extract_dense_layers. The forward pass is shared by
+        every output mask.
+
+        Args:
+            batch_interpolated: An array of shape (batch_size, num_features).
+            batch_masks: An array of output masks of shape
+                         (num_outputs, batch_size, num_classes), or None
+                         to take the gradient of the sum of the outputs.
+
+        Returns:
+            An array of shape (num_outputs, batch_size, num_features),
+            where num_outputs is 1 if batch_masks is None.
+        """
+        batch_outputs = batch_interpolated
+        layer_outputs = []
+        for kernel, bias, activation in self._dense_layers:
+            if kernel is not None:
+                batch_outputs = np.matmul(batch_outputs, kernel) + bias
+            if activation == 'relu':
+                batch_outputs = np.maximum(batch_outputs, 0.0)
+            elif activation == 'tanh':
+                batch_outputs = np.tanh(batch_outputs)
+            elif activation == 'sigmoid':
+                batch_outputs = 1.0 / (1.0 + np.exp(-batch_outputs))
+            elif activation == 'softmax':
+                batch_outputs = np.exp(batch_outputs - \
+                                       np.max(batch_outputs, axis=-1, keepdims=True))
+                batch_outputs = batch_outputs / np.sum(batch_outputs, axis=-1, keepdims=True)
+            layer_outputs.append(batch_outputs)
+
+        if batch_masks is None:
+            batch_gradients = np.ones((1,) + batch_outputs.shape,
+                                      dtype=batch_outputs.dtype)
+        else:
+            batch_gradients = batch_masks
+
+        # Backpropagate through the layers in reverse. The leading
+        # axis of the gradients indexes the output masks.
+        for (kernel, _, activation), batch_outputs in zip(reversed(self._dense_layers),
+                                                          reversed(layer_outputs)):
+            if activation == 'relu':
+                batch_gradients = batch_gradients * (batch_outputs > 0.0)
+            elif activation == 'tanh':
+                batch_gradients = batch_gradients * (1.0 - batch_outputs ** 2)
+            elif activation == 'sigmoid':
+                batch_gradients = batch_gradients * batch_outputs * (1.0 - batch_outputs)
+            elif activation == 'softmax':
+                batch_gradients = batch_outputs * \
+                    (batch_gradients - np.sum(batch_gradients * batch_outputs,
+                                              axis=-1, keepdims=True))
+            if kernel is not None:
+                batch_gradients = np.matmul(batch_gradients, kernel.T)
+        return batch_gradients
+
+    def _call_model(self, batch_interpolated, batch_input):
+        """
+        Internal helper function to call the model on
+        interpolated input, handling pass_original_input and
+        compute_dtype.
+
+        Args:
+            batch_interpolated: The interpolated input to the model.
+            batch_input: The original input, passed to the model
+                         if self.pass_original_input is set.
+        """
+        output_dtype = batch_interpolated.dtype
+        if self.compute_dtype is not None:
+            batch_interpolated = tf.cast(batch_interpolated, self.compute_dtype)
+            batch_input = tf.cast(batch_input, self.compute_dtype)
+
+        if self.pass_original_input:
+            batch_predictions = self.model(batch_interpolated,
+                                           original_input=batch_input)
+        else:
+            batch_predictions = self.model(batch_interpolated)
+
+        if self.compute_dtype is not None:
+            batch_predictions = tf.cast(batch_predictions, output_dtype)
+        return batch_predictions
+
     def accumulation_function(self,
                               batch_input,
                               batch_baseline,
                               batch_alphas,
                               output_index=None,
                               second_order=False,
-                              interaction_index=None):
+                              interaction_index=None,
+                              sample_weights=None):
         """
         A function that computes the logic of combining gradients and
         the difference from reference. This function is meant to
         be overloaded in the case of custom gradient logic.
 
+        A subclass that overrides this function is called as before: with
+        an integer or None output_index, one class at a time, without
+        sample_weights, and must return attributions of the same shape
+        as batch_input. Set accumulation_accepts_masks = True in the
+        body of the subclass to receive the masks and sample_weights
+        described below instead, which lets every class share a graph
+        and a forward pass.
+
         Args:
             batch_input: A batch of input to the model. The model
                          should be able to be called as self.model(batch_input).
@@ -59,41 +303,85 @@ class PathExplainerTF(Explainer):
             batch_alphas: A batch of interpolation constants.
             output_index: An integer. Which output to index into. If None,
                           will take the gradient with respect to the
-                          sum of the outputs.
+                          sum of the outputs. For first order attributions,
+                          this may also be a float mask of shape
+                          (batch_size, num_classes), in which case the gradient
+                          is taken with respect to the sum of each output row
+                          weighted by the matching mask row (e.g. one-hot
+                          rows), or a stack of such masks of shape
+                          (batch_size, num_outputs, num_classes), in which case
+                          the attributions for every mask are computed from a
+                          single forward pass and returned along a new axis 1.
+                          For second order interactions, this may be a float
+                          mask of shape (num_classes,).
             second_order: Set to True to return the hessian rather than
                           the gradient.
             interaction_index: An index into the features of the input. See
                                self.interactions for a complete description
                                of what this argument should be.
+            sample_weights: For first order attributions, an optional tensor
+                            of shape (k, num_samples), where batch_size is
+                            k * num_samples and each run of num_samples rows
+                            belongs to one input. If given, the attributions
+                            are summed over the samples of each input, weighted
+                            by sample_weights, and returned with a leading
+                            dimension of k. With a stack of masks, each output
+                            is summed before the gradient of the next is taken,
+                            so that only the summed attributions grow with
+                            num_outputs.
         """
         if not second_order:
+            # alpha * x + (1 - alpha) * b == b + alpha * (x - b), which
+            # reuses the difference rather than reading the input again.
             batch_difference = batch_input - batch_baseline
-            batch_interpolated = batch_alphas * batch_input + \
-                                 (1.0 - batch_alphas) * batch_baseline
+            batch_interpolated = batch_baseline + batch_alphas * batch_difference
 
             ########################
             # Compute the appropriate gradients
-            with tf.GradientTape() as tape:
+            multiple_outputs = tf.is_tensor(output_index) and \
+                               len(output_index.shape) == 3
+            with tf.GradientTape(persistent=multiple_outputs,
+                                 watch_accessed_variables=False) as tape:
                 tape.watch(batch_interpolated)
 
-                if self.pass_original_input:
-                    batch_predictions = self.model(batch_interpolated,
-                                                   original_input=batch_input)
-                else:
-                    batch_predictions = self.model(batch_interpolated)
+                batch_predictions = self._call_model(batch_interpolated, batch_input)
 
-                if output_index is not None:
+                if multiple_outputs:
+                    batch_targets = [tf.reduce_sum(batch_predictions * output_mask, axis=-1)
+                                     for output_mask in tf.unstack(output_index, axis=1)]
+                elif tf.is_tensor(output_index):
+                    batch_predictions = tf.reduce_sum(batch_predictions * output_index,
+                                                      axis=-1)
+                elif output_index is not None:
                     batch_predictions = batch_predictions[:, output_index]
+
+            if multiple_outputs:
+                # Shape [batch_size, num_outputs, ...], or [k, num_outputs, ...]
+                # if summed over the samples. The forward pass and its
+                # activations are shared by every backward pass.
+                batch_attributions = []
+                for batch_target in batch_targets:
+                    batch_gradients = tape.gradient(batch_target, batch_interpolated)
+                    output_attributions = batch_gradients * batch_difference
+                    if sample_weights is not None:
+                        output_attributions = self._sum_samples(output_attributions,
+                                                                sample_weights)
+                    batch_attributions.append(output_attributions)
+                del tape
+                return tf.stack(batch_attributions, axis=1)
+
             batch_gradients = tape.gradient(batch_predictions, batch_interpolated)
             ########################
 
             batch_attributions = batch_gradients * batch_difference
+            if sample_weights is not None:
+                batch_attributions = self._sum_samples(batch_attributions,
+                                                       sample_weights)
             return batch_attributions
 
         batch_alpha, batch_beta = batch_alphas
         batch_difference = batch_input - batch_baseline
-        batch_interpolated_beta = batch_beta * batch_input + \
-                                  (1.0 - batch_beta) * batch_baseline
+        batch_interpolated_beta = batch_baseline + batch_beta * batch_difference
 
         ################################################
         # Handle the second order derivatives here
@@ -101,18 +389,16 @@ class PathExplainerTF(Explainer):
             second_order_tape.watch(batch_interpolated_beta)
 
             batch_difference_beta = batch_interpolated_beta - batch_baseline
-            batch_interpolated_alpha = batch_alpha * batch_interpolated_beta + \
-                                       (1.0 - batch_alpha) * batch_baseline
+            batch_interpolated_alpha = batch_baseline + batch_alpha * batch_difference_beta
             with tf.GradientTape() as first_order_tape:
                 first_order_tape.watch(batch_interpolated_alpha)
 
-                if self.pass_original_input:
-                    batch_predictions = self.model(batch_interpolated_alpha,
-                                                   original_input=batch_input)
-                else:
-                    batch_predictions = self.model(batch_interpolated_alpha)
+                batch_predictions = self._call_model(batch_interpolated_alpha, batch_input)
 
-                if output_index is not None:
+                if tf.is_tensor(output_index):
+                    batch_predictions = tf.reduce_sum(batch_predictions * output_index,
+                                                      axis=-1)
+                elif output_index is not None:
                     batch_predictions = batch_predictions[:, output_index]
 
             # Same shape as the input, e.g. [batch_size, ...]
@@ -153,51 +439,138 @@ class PathExplainerTF(Explainer):
         batch_interactions = batch_hessian * batch_difference
         return batch_interactions
 
-    def _sample_baseline(self, baseline, number_to_draw, use_expectation):
+    def _accepts_output_masks(self):
+        """
+        Internal helper function that returns whether the class
+        defining accumulation_function opted in to output masks.
+        """
+        for cls in type(self).__mro__:
+            if 'accumulation_function' in vars(cls):
+                return vars(cls).get('accumulation_accepts_masks', False)
+        return False
+
+    def _sum_samples(self, batch_attributions, sample_weights):
         """
-        An internal function to sample the baseline.
+        Internal helper function that sums attributions of shape
+        (k * num_samples, ...) over the samples of each input, weighted
+        by sample_weights of shape (k, num_samples).
+        """
+        sample_shape = tf.shape(sample_weights)
+        batch_attributions = tf.reshape(batch_attributions,
+                                        tf.concat([sample_shape,
+                                                   tf.shape(batch_attributions)[1:]],
+                                                  axis=0))
+        weight_shape = tf.concat([sample_shape,
+                                  tf.ones(len(batch_attributions.shape) - 2, dtype=tf.int32)],
+                                 axis=0)
+        return tf.reduce_sum(batch_attributions * tf.reshape(sample_weights, weight_shape),
+                             axis=1)
+
+    def _sample_baseline_indices(self, num_baselines, num_inputs,
+                                 num_samples, use_expectation,
+                                 allow_shared=False):
+        """
+        An internal function to sample which baseline each
+        sample of each input is drawn from. Sampling is done
+        once per call, on device.
 
         Args:
-            baseline: The baseline tensor
-            number_to_draw: The number of samples to draw
+            num_baselines: The number of baselines to draw from
+            num_inputs: The number of inputs being explained
+            num_samples: The number of samples to draw per input
             use_expectation: Whether or not to sample baselines
                              or use a single baseline
+            allow_shared: Set to True to return indices of shape
+                          (1, num_samples) when every input uses the
+                          same baseline draws, so that those baselines
+                          are only gathered once and broadcast across inputs.
 
         Returns:
-            A tensor of shape (number_to_draw, ...) representing
-            the baseline and a tensor of shape (number_to_draw) representing
-            the sampled interpolation constants
+            An int32 tensor of shape (num_inputs, num_samples)
+            indexing into the baseline
         """
+        shape = (num_inputs, num_samples)
         if use_expectation:
-            replace = baseline.shape[0] < number_to_draw
-            sample_indices = np.random.choice(baseline.shape[0],
-                                              size=number_to_draw,
-                                              replace=replace)
-            sampled_baseline = tf.gather(baseline, sample_indices)
+            return tf.random.uniform(shape,
+                                     minval=0,
+                                     maxval=num_baselines,
+                                     dtype=tf.int32)
+
+        if num_baselines > 1:
+            baseline_indices = tf.range(num_inputs, dtype=tf.int32)
+        elif allow_shared:
+            return tf.zeros((1, num_samples), dtype=tf.int32)
         else:
-            reps = np.ones(len(baseline.shape)).astype(int)
-            reps[0] = number_to_draw
-            sampled_baseline = np.tile(baseline, reps)
-        return sampled_baseline
+            baseline_indices = tf.zeros(num_inputs, dtype=tf.int32)
+        return tf.broadcast_to(tf.expand_dims(baseline_indices, axis=1), shape)
+
+    def _quadrature(self, num_samples, quadrature):
+        """
+        An internal function to get the nodes and weights of
+        a quadrature rule over the interval [0, 1].
+
+        Args:
+            num_samples: Number of nodes
+            quadrature: One of 'riemann', 'trapezoid' or 'gauss_legendre'.
+                        'riemann' places equally weighted nodes
+                        at num_samples linearly spaced points including
+                        both endpoints. 'trapezoid' uses the same nodes
+                        but halves the weight of the endpoints.
+                        'gauss_legendre' uses Gauss-Legendre nodes, which
+                        integrate smooth paths accurately with far fewer
+                        samples.
+
+        Returns:
+            An array of nodes and an array of weights summing to one,
+            each of shape (num_samples,)
+        """
+        if quadrature == 'gauss_legendre':
+            nodes, weights = np.polynomial.legendre.leggauss(num_samples)
+            return (nodes + 1.0) / 2.0, weights / 2.0
 
-    def _sample_alphas(self, num_samples, use_expectation, use_product=False):
+        nodes = np.linspace(start=0.0,
+                            stop=1.0,
+                            num=num_samples,
+                            endpoint=True)
+        weights = np.ones(num_samples)
+        if quadrature == 'trapezoid':
+            if num_samples > 1:
+                weights[0] = 0.5
+                weights[-1] = 0.5
+        elif quadrature != 'riemann':
+            raise ValueError('Unrecognized quadrature rule: {}'.format(quadrature))
+        return nodes, weights / np.sum(weights)
+
+    def _sample_alphas(self, num_inputs, num_samples, use_expectation,
+                       use_product=False, dtype=tf.float32, quadrature='riemann'):
         """
         An internal function to sample the interpolation constant.
+        Sampling is done once per call, on device.
 
         Args:
-            num_samples: Number of alphas to draw
+            num_inputs: The number of inputs being explained
+            num_samples: Number of alphas to draw per input
             use_expectation: Whether or not to use
                              expected gradients-style sampling
             use_product: Set to true to sample from
                          the product distribution
+            dtype: The dtype of the returned alphas
+            quadrature: The quadrature rule whose nodes are used
+                        when use_expectation and use_product are False.
+                        See self._quadrature.
+
+        Returns:
+            A tensor of shape (num_inputs, num_samples), or
+            a tuple of two such tensors if use_product is True
         """
+        shape = (num_inputs, num_samples)
         if use_expectation:
             if use_product:
-                alpha = np.random.uniform(low=0.0, high=1.0, size=num_samples).astype(np.float32)
-                beta = np.random.uniform(low=0.0, high=1.0, size=num_samples).astype(np.float32)
+                alpha = tf.random.uniform(shape, minval=0.0, maxval=1.0, dtype=dtype)
+                beta = tf.random.uniform(shape, minval=0.0, maxval=1.0, dtype=dtype)
                 return alpha, beta
             else:
-                return np.random.uniform(low=0.0, high=1.0, size=num_samples).astype(np.float32)
+                return tf.random.uniform(shape, minval=0.0, maxval=1.0, dtype=dtype)
         else:
             if use_product:
                 sqrt_samples = np.ceil(np.sqrt(num_samples)).astype(int)
@@ -219,57 +592,303 @@ class PathExplainerTF(Explainer):
                 alpha = np.outer(ones_map, spaced_points).flatten()
                 alpha = alpha[slice_indices]
 
-                return alpha, beta
+                return tf.broadcast_to(tf.constant(alpha, dtype=dtype), shape), \
+                       tf.broadcast_to(tf.constant(beta, dtype=dtype), shape)
+            else:
+                alpha, _ = self._quadrature(num_samples, quadrature)
+                return tf.broadcast_to(tf.constant(alpha, dtype=dtype), shape)
+
+    def _compile(self, function, input_signature):
+        """
+        Internal helper function that wraps a function in
+        a tf.function, compiling it with XLA if self.use_xla is set.
+        On the first eager call, the function is lowered to XLA
+        before it is run. If that lowering fails, e.g. because the
+        model contains operations that XLA does not support, a
+        warning is raised and this permanently falls back to the
+        uncompiled graph. Errors raised while running the function,
+        such as errors in the data, are never caught.
+
+        Args:
+            function: The python function to compile.
+            input_signature: A list of tf.TensorSpec objects.
+        """
+        graph_function = tf.function(function, input_signature=input_signature)
+        if not self.use_xla:
+            return graph_function
+
+        xla_function = tf.function(function,
+                                   input_signature=input_signature,
+                                   jit_compile=True)
+        state = {'function': xla_function, 'checked': False}
+
+        def compiled_function(*args):
+            if not state['checked']:
+                if not tf.executing_eagerly():
+                    # The compilation can't be checked while tracing
+                    # an outer function, so don't commit to XLA yet.
+                    return graph_function(*args)
+                try:
+                    xla_function.experimental_get_compiler_ir(*args)(stage='hlo')
+                except (tf.errors.InvalidArgumentError,
+                        tf.errors.UnimplementedError) as error:
+                    warnings.warn('XLA could not compile the model, so the ' + \
+                                  'explainer falls back to running it without ' + \
+                                  'XLA. Pass use_xla=False to silence this ' + \
+                                  'warning. The error was: {}'.format(error))
+                    state['function'] = graph_function
+                state['checked'] = True
+            return state['function'](*args)
+        return compiled_function
+
+    def _grad_step(self, input_shape, dtype, mask_shape=None, sample_alphas=False,
+                   output_index=None):
+        """
+        Internal helper function that returns a graph-compiled
+        version of the first-order accumulation function. One
+        function is traced per input signature and output mode,
+        and is then reused across every batch of inputs.
+
+        The returned function takes a batch of inputs of shape
+        (k, ...), the full baseline tensor, indices into the baseline
+        of shape (k, num_samples) or (1, num_samples), optionally output masks
+        of shape (k,) + mask_shape or (1,) + mask_shape, and either a batch of interpolation
+        constants of shape (k, num_samples) together with quadrature
+        weights of shape (num_samples,), or an int64 seed of shape (2,)
+        to draw the interpolation constants from. It gathers the baselines
+        and flattens the leading two dimensions so that all
+        samples of all k inputs go through the model in a single call,
+        and returns the attributions summed over the samples,
+        weighted by the quadrature weights if they are given.
+
+        Args:
+            input_shape: The shape of a single input, not including
+                         the batch dimension.
+            dtype: The dtype of the input.
+            mask_shape: If not None, the returned function takes an
+                        output mask of this shape per input, or one
+                        shared by every input, to weight the outputs by.
+                        See accumulation_function. Because the mask is a
+                        tensor, a single graph serves every class, and
+                        inputs explaining different classes share a batch.
+            sample_alphas: Set to True to draw the interpolation constants
+                           uniformly at random inside the graph, where
+                           they are fused with the interpolation. The
+                           returned function then takes a seed rather
+                           than alphas and weights. The draw is stateless,
+                           so that it only depends on the seed, even
+                           when compiled with XLA.
+            output_index: An integer output index, for an accumulation_function
+                          that does not accept output masks. One function is
+                          traced per index.
+        """
+        input_shape = tuple(input_shape)
+        if mask_shape is not None:
+            mask_shape = tuple(mask_shape)
+        key = (input_shape, dtype, mask_shape, sample_alphas, output_index)
+        if not hasattr(self, '_grad_steps'):
+            self._grad_steps = {}
+        if key not in self._grad_steps:
+            accepts_output_masks = self._accepts_output_masks()
+            flat_shape = (-1,) + input_shape
+            alpha_shape = (-1,) + (1,) * len(input_shape)
+
+            def grad_step(batch_input, baseline, batch_baseline_indices, *args):
+                args = list(args)
+                output_mask = None
+                if mask_shape is not None:
+                    output_mask = args.pop(0)
+                sample_shape = tf.stack([tf.shape(batch_input)[0],
+                                         tf.shape(batch_baseline_indices)[1]])
+                if sample_alphas:
+                    seed, = args
+                    batch_alphas = tf.random.stateless_uniform(sample_shape,
+                                                               seed=seed,
+                                                               minval=0.0,
+                                                               maxval=1.0,
+                                                               dtype=dtype)
+                else:
+                    batch_alphas, batch_weights = args
+                batch_alphas = tf.broadcast_to(batch_alphas, sample_shape)
+                if sample_alphas:
+                    sample_weights = tf.ones(sample_shape, dtype=dtype)
+                else:
+                    sample_weights = tf.broadcast_to(batch_weights, sample_shape)
+
+                # Baseline indices shared by every input have a leading
+                # dimension of 1, so the baselines are gathered once and
+                # broadcast. Broadcasting rather than tiling lets XLA fuse
+                # the repeated input and baseline into their consumers
+                # instead of writing copies of them to memory.
+                batch_shape = tf.concat([sample_shape, tf.shape(baseline)[1:]], axis=0)
+                batch_baseline = tf.gather(baseline, batch_baseline_indices)
+                batch_baseline = tf.broadcast_to(batch_baseline, batch_shape)
+                flat_input = tf.broadcast_to(tf.expand_dims(batch_input, axis=1),
+                                             batch_shape)
+                flat_input = tf.reshape(flat_input, flat_shape)
+                flat_baseline = tf.reshape(batch_baseline, flat_shape)
+                flat_alphas = tf.reshape(batch_alphas, alpha_shape)
+                if output_mask is not None:
+                    # One mask row per model input row.
+                    mask_batch_shape = tf.concat([sample_shape, mask_shape], axis=0)
+                    output_mask = tf.broadcast_to(tf.expand_dims(output_mask, axis=1),
+                                                  mask_batch_shape)
+                    output_mask = tf.reshape(output_mask, (-1,) + mask_shape)
+
+                if accepts_output_masks:
+                    return self.accumulation_function(flat_input,
+                                                      flat_baseline,
+                                                      flat_alphas,
+                                                      output_index=output_mask,
+                                                      second_order=False,
+                                                      interaction_index=None,
+                                                      sample_weights=sample_weights)
+
+                flat_attributions = self.accumulation_function(flat_input,
+                                                               flat_baseline,
+                                                               flat_alphas,
+                                                               output_index=output_index,
+                                                               second_order=False,
+                                                               interaction_index=None)
+                return self._sum_samples(flat_attributions, sample_weights)
+
+            input_spec = tf.TensorSpec((None,) + input_shape, dtype)
+            index_spec = tf.TensorSpec((None, None), tf.int32)
+            input_signature = [input_spec, input_spec, index_spec]
+            if mask_shape is not None:
+                input_signature.append(tf.TensorSpec((None,) + mask_shape, dtype))
+            if sample_alphas:
+                input_signature.append(tf.TensorSpec((2,), tf.int64))
             else:
-                return np.linspace(start=0.0,
-                                   stop=1.0,
-                                   num=num_samples,
-                                   endpoint=True).astype(np.float32)
+                input_signature.append(tf.TensorSpec((None, None), dtype))
+                input_signature.append(tf.TensorSpec((None,), dtype))
+            self._grad_steps[key] = self._compile(grad_step, input_signature)
+        return self._grad_steps[key]
 
-    def _single_attribution(self, current_input, current_baseline,
-                            current_alphas, num_samples, batch_size,
-                            use_expectation, output_index):
+    def _input_dataset(self, inputs, job_indices, inputs_per_batch):
+        """
+        Internal helper function that returns a tf.data pipeline
+        yielding (batch_indices, batch_inputs) pairs. Prefetching
+        lets the next batch of inputs be gathered while the model
+        runs on the current one.
+
+        Args:
+            inputs: The full tensor of inputs.
+            job_indices: An array of indices into inputs.
+            inputs_per_batch: The number of inputs in each batch.
+        """
+        dataset = tf.data.Dataset.from_tensor_slices(job_indices.astype(np.int32))
+        dataset = dataset.batch(inputs_per_batch)
+        dataset = dataset.map(lambda batch_indices: (batch_indices,
+                                                     tf.gather(inputs, batch_indices)))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def _batch_attribution(self, batch_inputs, baseline, batch_indices,
+                           baseline_indices, alphas, weights, num_samples,
+                           batch_size, output_masks, alpha_seed=None,
+                           output_index=None):
         """
         A helper function to compute path
-        attributions for a single sample.
+        attributions for a batch of inputs.
 
         Args:
-            current_input: A single sample. Assumes that
-                           it is of shape (...) where ...
-                           represents the input dimensionality
+            batch_inputs: A batch of inputs of shape (k, ...).
             baseline: A tensor representing the baseline input.
-            current_alphas: Which alphas to use when interpolating
+            batch_indices: The indices of batch_inputs in the full
+                           tensor of inputs. These inputs are
+                           explained together in as few model calls
+                           as batch_size allows.
+            baseline_indices: An int32 tensor of shape (num_inputs, num_samples),
+                              or (1, num_samples) if shared by every input,
+                              indexing into the baseline.
+            alphas: A tensor of shape (num_inputs, num_samples) of
+                    interpolation constants, or None to sample them
+                    uniformly inside the graph using alpha_seed.
+            weights: A tensor of shape (num_samples,) of quadrature
+                     weights summing to one. Must be given if and only
+                     if alphas is given.
             num_samples: The number of samples to draw
             batch_size: Batch size to input to the model
-            use_expectation: Whether or not to sample the baseline
-            output_index: Whether or not to index into a given class
+            output_masks: None, or a tensor of one-hot output masks of
+                          shape (num_inputs, ...) or (1, ...) if shared by
+                          every input. See accumulation_function.
+            alpha_seed: A scalar int64 tensor. Must be given if and only
+                        if alphas is None. Each model call draws its
+                        interpolation constants from a seed made of
+                        alpha_seed and the position of that call, so
+                        the results do not depend on the order in which
+                        batches are run.
+            output_index: An integer output index, used instead of
+                          output_masks for an accumulation_function that
+                          does not accept output masks.
         """
-        current_input = np.expand_dims(current_input, axis=0)
-        current_alphas = tf.reshape(current_alphas, (num_samples,) + \
-                                    (1,) * (len(current_input.shape) - 1))
+        batch_baseline_indices = baseline_indices
+        if baseline_indices.shape[0] > 1:
+            batch_baseline_indices = tf.gather(baseline_indices, batch_indices)
+        if alphas is not None:
+            batch_alphas = tf.gather(alphas, batch_indices)
+        batch_output_masks = output_masks
+        if output_masks is not None and output_masks.shape[0] > 1:
+            batch_output_masks = tf.gather(output_masks, batch_indices)
 
-        attribution_array = []
-        for j in range(0, num_samples, batch_size):
-            number_to_draw = min(batch_size, num_samples - j)
-
-            batch_baseline = self._sample_baseline(current_baseline,
-                                                   number_to_draw,
-                                                   use_expectation)
-            batch_alphas = current_alphas[j:min(j + batch_size, num_samples)]
-
-            reps = np.ones(len(current_input.shape)).astype(int)
-            reps[0] = number_to_draw
-            batch_input = tf.convert_to_tensor(np.tile(current_input, reps))
-
-            batch_attributions = self.accumulation_function(batch_input,
-                                                            batch_baseline,
-                                                            batch_alphas,
-                                                            output_index=output_index,
-                                                            second_order=False,
-                                                            interaction_index=None)
-            attribution_array.append(batch_attributions)
-        attribution_array = np.concatenate(attribution_array, axis=0)
-        attributions = np.mean(attribution_array, axis=0)
+        samples_per_batch = min(num_samples, max(1, batch_size))
+
+        ########################
+        # A stack of masks computes the gradients of every mask from
+        # one forward pass. Each mask's attributions are summed over
+        # the samples before the next gradient is taken, so what grows
+        # with the number of masks is the summed attributions of the
+        # inputs, one per input and mask. The masks are split into
+        # chunks so that those stay within batch_size.
+        mask_chunks = [batch_output_masks]
+        if output_masks is not None and len(output_masks.shape) == 3:
+            inputs_per_call = max(1, batch_size // num_samples)
+            masks_per_call = max(1, batch_size // inputs_per_call)
+            num_masks = output_masks.shape[1]
+            mask_chunks = [batch_output_masks[:, c:c + masks_per_call]
+                           for c in range(0, num_masks, masks_per_call)]
+        ########################
+
+        calls_per_chunk = -(-num_samples // samples_per_batch)
+        # The smallest index rather than the first, since a replica
+        # may be handed an empty shard of the last batch.
+        call_offset = tf.cast(tf.reduce_min(batch_indices), tf.int64) * \
+                      len(mask_chunks) * calls_per_chunk
+
+        chunk_attributions = []
+        for c, mask_chunk in enumerate(mask_chunks):
+            grad_step = self._grad_step(batch_inputs.shape[1:],
+                                        batch_inputs.dtype,
+                                        mask_shape=None if mask_chunk is None else mask_chunk.shape[1:],
+                                        sample_alphas=alphas is None,
+                                        output_index=output_index)
+
+            attributions = None
+            for j in range(0, num_samples, samples_per_batch):
+                step_args = [batch_inputs,
+                             baseline,
+                             batch_baseline_indices[:, j:j + samples_per_batch]]
+                if mask_chunk is not None:
+                    step_args.append(mask_chunk)
+                if alphas is None:
+                    call_number = c * calls_per_chunk + j // samples_per_batch
+                    step_args.append(tf.stack([alpha_seed, call_offset + call_number]))
+                else:
+                    step_args.append(batch_alphas[:, j:j + samples_per_batch])
+                    step_args.append(weights[j:j + samples_per_batch])
+                batch_attributions = grad_step(*step_args)
+                if attributions is None:
+                    attributions = batch_attributions
+                else:
+                    attributions = attributions + batch_attributions
+            chunk_attributions.append(attributions)
+
+        if len(chunk_attributions) > 1:
+            attributions = tf.concat(chunk_attributions, axis=1)
+        else:
+            attributions = chunk_attributions[0]
+        if alphas is None:
+            attributions = attributions / num_samples
         return attributions
 
     def _get_test_output(self,
@@ -306,21 +925,103 @@ class PathExplainerTF(Explainer):
                           2 * list(inputs.shape[1:])
             shape_tuple = tuple(shape_tuple)
 
+        # Match the dtype of the gradients so that writing
+        # into the array doesn't need a cast.
+        dtype = tf.as_dtype(inputs.dtype).as_numpy_dtype
+
         if is_multi_output and output_indices is None:
             num_classes = test_output.shape[-1]
-            attributions = np.zeros((num_classes,) + shape_tuple)
+            attributions = np.zeros((num_classes,) + shape_tuple, dtype=dtype)
         elif not is_multi_output and output_indices is not None:
             raise ValueError('Provided output_indices but ' + \
                              'model is not multi output!')
         else:
-            attributions = np.zeros(shape_tuple)
+            attributions = np.zeros(shape_tuple, dtype=dtype)
 
         return attributions, is_multi_output, num_classes
 
+    def _dense_attributions(self, inputs, baseline, batch_size, num_samples,
+                            use_expectation, output_indices, verbose, quadrature):
+        """
+        Internal helper function that computes path attributions
+        with the numpy backend. See self.attributions for a
+        description of the arguments.
+        """
+        attributions, is_multi_output, num_classes = self._init_array(inputs,
+                                                                      output_indices)
+        inputs = np.asarray(inputs)
+        baseline = np.asarray(baseline, dtype=inputs.dtype)
+        if len(inputs.shape) != 2:
+            raise ValueError('The numpy backend only supports inputs ' + \
+                             'of shape (batch_size, num_features)!')
+        num_inputs = inputs.shape[0]
+        num_baselines = baseline.shape[0]
+
+        if use_expectation:
+            alphas = np.random.uniform(size=(num_inputs, num_samples))
+            baseline_indices = np.random.randint(num_baselines,
+                                                 size=(num_inputs, num_samples))
+            weights = np.full(num_samples, 1.0 / num_samples)
+        else:
+            nodes, weights = self._quadrature(num_samples, quadrature)
+            alphas = np.broadcast_to(nodes, (num_inputs, num_samples))
+            if num_baselines > 1:
+                baseline_indices = np.arange(num_inputs)
+            else:
+                baseline_indices = np.zeros(num_inputs, dtype=int)
+            baseline_indices = np.broadcast_to(baseline_indices[:, np.newaxis],
+                                               (num_inputs, num_samples))
+        alphas = alphas.astype(inputs.dtype)
+        weights = weights.astype(inputs.dtype)
+
+        ########################
+        # Output masks of shape (num_outputs, num_inputs, num_classes).
+        output_masks = None
+        if is_multi_output:
+            if output_indices is None:
+                output_masks = np.eye(num_classes, dtype=inputs.dtype)[:, np.newaxis, :]
+            else:
+                output_indices = np.broadcast_to(output_indices, (num_inputs,))
+                output_masks = np.eye(num_classes, dtype=inputs.dtype)[output_indices]
+                output_masks = output_masks[np.newaxis]
+            output_masks = np.broadcast_to(output_masks,
+                                           (output_masks.shape[0], num_inputs, num_classes))
+        ########################
+
+        inputs_per_batch = max(1, batch_size // num_samples)
+        iterable = range(0, num_inputs, inputs_per_batch)
+        if verbose:
+            iterable = tqdm(iterable)
+
+        for i in iterable:
+            batch_indices = slice(i, i + inputs_per_batch)
+            batch_input = inputs[batch_indices, np.newaxis]
+            batch_baseline = baseline[baseline_indices[batch_indices]]
+            batch_difference = batch_input - batch_baseline
+            batch_interpolated = batch_baseline + \
+                                 alphas[batch_indices, :, np.newaxis] * batch_difference
+
+            batch_masks = None
+            if output_masks is not None:
+                batch_masks = np.repeat(output_masks[:, batch_indices], num_samples, axis=1)
+
+            batch_gradients = self._dense_gradients(
+                batch_interpolated.reshape(-1, inputs.shape[1]),
+                batch_masks)
+            batch_gradients = batch_gradients.reshape((-1,) + batch_difference.shape)
+            batch_attributions = np.sum(batch_gradients * batch_difference * \
+                                        weights[:, np.newaxis], axis=2)
+
+            if is_multi_output and output_indices is None:
+                attributions[:, batch_indices] = batch_attributions
+            else:
+                attributions[batch_indices] = batch_attributions[0]
+        return attributions
+
     def attributions(self, inputs, baseline,
                      batch_size=50, num_samples=100,
                      use_expectation=True, output_indices=None,
-                     verbose=False):
+                     verbose=False, quadrature='riemann'):
         """
         A function to compute path attributions on the given
         inputs.
@@ -336,6 +1037,10 @@ class PathExplainerTF(Explainer):
                          expectation or integral.
             use_expectation: If True, this samples baselines and interpolation
                              constants uniformly at random (expected gradients).
+                             The samples are drawn with TensorFlow, so call
+                             tf.random.set_seed, not np.random.seed, for
+                             reproducible results (or np.random.seed with
+                             backend='numpy').
                              If False, then this assumes num_refs=1 in which
                              case it uses the same baseline for all inputs,
                              or num_refs=batch_size, in which case it uses
@@ -347,60 +1052,240 @@ class PathExplainerTF(Explainer):
                              integer tensor of shape [batch_size] to
                              index the output output_indices[i] for
                              the input inputs[i].
+            quadrature: The rule used to approximate the path integral
+                        when use_expectation is False. One of 'riemann',
+                        'trapezoid' or 'gauss_legendre'. 'gauss_legendre'
+                        usually needs far fewer num_samples for the same
+                        accuracy. Must be 'riemann' if use_expectation is True.
         """
+        if use_expectation and quadrature != 'riemann':
+            raise ValueError('A quadrature rule can only be used ' + \
+                             'when use_expectation is False!')
+        self._check_baseline(inputs, baseline, use_expectation)
+
+        if self.backend == 'numpy':
+            return self._dense_attributions(inputs, baseline, batch_size,
+                                            num_samples, use_expectation,
+                                            output_indices, verbose, quadrature)
+
         attributions, is_multi_output, num_classes = self._init_array(inputs,
                                                                       output_indices)
+        num_inputs = inputs.shape[0]
+        all_indices = np.arange(num_inputs)
 
-        input_iterable = enumerate(inputs)
-        if verbose:
-            input_iterable = enumerate(tqdm(inputs))
+        # Convert once here rather than on every batch.
+        inputs = tf.convert_to_tensor(inputs)
+        dtype = inputs.dtype
+        baseline = tf.cast(baseline, dtype)
+        # Expected gradients draws its alphas inside the graph, from a
+        # seed drawn here so that tf.random.set_seed controls it.
+        alphas = None
+        weights = None
+        alpha_seed = None
+        if use_expectation:
+            alpha_seed = tf.random.uniform((), maxval=tf.int64.max, dtype=tf.int64)
+        else:
+            alphas = self._sample_alphas(num_inputs, num_samples,
+                                         use_expectation, dtype=dtype,
+                                         quadrature=quadrature)
+            _, weights = self._quadrature(num_samples, quadrature)
+            weights = tf.constant(weights, dtype=dtype)
+        baseline_indices = self._sample_baseline_indices(baseline.shape[0],
+                                                         num_inputs,
+                                                         num_samples,
+                                                         use_expectation,
+                                                         allow_shared=True)
 
-        for i, current_input in input_iterable:
-            current_alphas = self._sample_alphas(num_samples, use_expectation)
+        ########################
+        # Classes are selected with one-hot masks rather than
+        # integers, so that inputs explaining different classes
+        # share every batch and every graph. A mask with a leading
+        # dimension of 1 is shared by every input. When explaining
+        # every class, a stack of masks computes all classes at once
+        # and the results are written into a view of the output
+        # whose second axis is the class axis.
+        target = attributions
+        output_masks = None
+        if is_multi_output:
+            if output_indices is None:
+                target = np.moveaxis(attributions, 0, 1)
+                output_masks = tf.one_hot([list(range(num_classes))],
+                                          num_classes, dtype=dtype)
+            elif isinstance(output_indices, int):
+                output_masks = tf.one_hot([output_indices], num_classes,
+                                          dtype=dtype)
+            else:
+                output_masks = tf.one_hot(tf.cast(output_indices, tf.int32),
+                                          num_classes, dtype=dtype)
 
-            if not use_expectation and baseline.shape[0] > 1:
-                current_baseline = np.expand_dims(baseline[i], axis=0)
+        # Each job is (output_masks, output_index, the indices of the
+        # inputs it explains, the class axis position it writes to).
+        # An accumulation_function that only takes integer output
+        # indices is run once per class instead.
+        jobs = [(output_masks, None, all_indices, None)]
+        if is_multi_output and not self._accepts_output_masks():
+            if output_indices is None:
+                jobs = [(None, output_index, all_indices, output_index)
+                        for output_index in range(num_classes)]
+            elif isinstance(output_indices, int):
+                jobs = [(None, output_indices, all_indices, None)]
             else:
-                current_baseline = baseline
+                output_indices = np.asarray(output_indices)
+                jobs = [(None, int(output_index),
+                         np.flatnonzero(output_indices == output_index), None)
+                        for output_index in np.unique(output_indices)]
+        ########################
 
-            if is_multi_output:
-                if output_indices is not None:
-                    if isinstance(output_indices, int):
-                        output_index = output_indices
-                    else:
-                        output_index = output_indices[i]
-                    current_attributions = self._single_attribution(current_input,
-                                                                    current_baseline,
-                                                                    current_alphas,
-                                                                    num_samples,
-                                                                    batch_size,
-                                                                    use_expectation,
-                                                                    output_index)
-                    attributions[i] = current_attributions
+        # Results are scattered into a device-side variable and
+        # copied to the host once, after every batch is done.
+        device_target = tf.Variable(tf.zeros(target.shape, dtype=dtype))
+
+        # batch_size bounds the number of samples each replica
+        # feeds to the model at once, so with a distribution
+        # strategy the global batch of inputs is scaled up.
+        inputs_per_batch = max(1, batch_size // num_samples)
+        if self.strategy is not None:
+            inputs_per_batch *= self.strategy.num_replicas_in_sync
+
+        progress = None
+        if verbose:
+            progress = tqdm(total=sum(len(job_indices) for _, _, job_indices, _ in jobs))
+
+        for job_masks, job_index, job_indices, job_class in jobs:
+            def attribute_batch(batch_indices, batch_inputs):
+                return self._batch_attribution(batch_inputs,
+                                               baseline,
+                                               batch_indices,
+                                               baseline_indices,
+                                               alphas,
+                                               weights,
+                                               num_samples,
+                                               batch_size,
+                                               job_masks,
+                                               alpha_seed,
+                                               output_index=job_index)
+
+            dataset = self._input_dataset(inputs, job_indices, inputs_per_batch)
+            if self.strategy is not None:
+                dataset = self.strategy.experimental_distribute_dataset(dataset)
+
+                # The replicas are traced in separate threads. Explaining the
+                # first input eagerly here builds every compiled step and settles
+                # whether it uses XLA, so that the replicas only call functions
+                # that already exist. Its result is overwritten below.
+                first_indices = tf.constant(job_indices[:1], dtype=tf.int32)
+                attribute_batch(first_indices, tf.gather(inputs, first_indices))
+
+                @tf.function
+                def distributed_step(batch_indices, batch_inputs):
+                    return self.strategy.run(attribute_batch,
+                                             args=(batch_indices, batch_inputs))
+
+            for batch_indices, batch_inputs in dataset:
+                if self.strategy is None:
+                    replica_indices = [batch_indices]
+                    replica_attributions = [attribute_batch(batch_indices, batch_inputs)]
                 else:
-                    for output_index in range(num_classes):
-                        current_attributions = self._single_attribution(current_input,
-                                                                        current_baseline,
-                                                                        current_alphas,
-                                                                        num_samples,
-                                                                        batch_size,
-                                                                        use_expectation,
-                                                                        output_index)
-                        attributions[output_index, i] = current_attributions
-            else:
-                current_attributions = self._single_attribution(current_input,
-                                                                current_baseline,
-                                                                current_alphas,
-                                                                num_samples,
-                                                                batch_size,
-                                                                use_expectation,
-                                                                None)
-                attributions[i] = current_attributions
+                    # Each replica explains its own shard of the batch. Since
+                    # the attributions of different inputs are independent,
+                    # the shards are written back without any reduction.
+                    per_replica = distributed_step(batch_indices, batch_inputs)
+                    replica_indices = self.strategy.experimental_local_results(batch_indices)
+                    replica_attributions = self.strategy.experimental_local_results(per_replica)
+
+                for current_indices, current_attributions in zip(replica_indices,
+                                                                 replica_attributions):
+                    scatter_indices = tf.expand_dims(current_indices, axis=1)
+                    if job_class is not None:
+                        scatter_indices = tf.stack([current_indices,
+                                                    tf.fill(tf.shape(current_indices), job_class)],
+                                                   axis=1)
+                    device_target.scatter_nd_update(scatter_indices, current_attributions)
+                    if progress is not None:
+                        progress.update(current_indices.shape[0])
+
+        if progress is not None:
+            progress.close()
+        target[...] = device_target.numpy()
         return attributions
 
-    def _single_interaction(self, current_input, current_baseline,
-                            current_alphas, num_samples, batch_size,
-                            use_expectation, output_index,
+    def _interaction_step(self, input_shape, dtype, num_classes, interaction_index,
+                          output_index=None):
+        """
+        Internal helper function that returns a graph-compiled
+        version of the second-order accumulation function. The
+        batch dimension is left unspecified in the input signature,
+        so that sub-batches of any size, including the last, smaller
+        one, share a single trace.
+
+        The returned function takes a single input of shape (1, ...),
+        the full baseline tensor, indices into the baseline of shape
+        (batch,), optionally an output mask of shape (num_classes,) and two
+        batches of interpolation constants of shape (batch,). It returns the
+        interactions summed over the batch.
+
+        Args:
+            input_shape: The shape of a single input, not including
+                         the batch dimension.
+            dtype: The dtype of the input.
+            num_classes: If not None, the returned function takes a
+                         one-hot output mask of shape (num_classes,). Because
+                         the mask is a tensor, a single graph serves every class.
+            interaction_index: The index to take the interactions with
+                               respect to, or None.
+            output_index: An integer output index, for an accumulation_function
+                          that does not accept output masks. One function is
+                          traced per index.
+        """
+        input_shape = tuple(input_shape)
+        if num_classes is not None:
+            num_classes = int(num_classes)
+        if output_index is not None:
+            output_index = int(output_index)
+        if interaction_index is not None:
+            interaction_index = tuple(interaction_index)
+        key = (input_shape, dtype, num_classes, interaction_index, output_index)
+        if not hasattr(self, '_interaction_steps'):
+            self._interaction_steps = {}
+        if key not in self._interaction_steps:
+            alpha_shape = (-1,) + (1,) * len(input_shape)
+            index_list = None if interaction_index is None else list(interaction_index)
+
+            def interaction_step(current_input, baseline, batch_baseline_indices, *args):
+                args = list(args)
+                step_output = output_index
+                if num_classes is not None:
+                    step_output = args.pop(0)
+                batch_alpha, batch_beta = args
+                batch_baseline = tf.gather(baseline, batch_baseline_indices)
+                batch_input = tf.broadcast_to(current_input, tf.shape(batch_baseline))
+                batch_alpha = tf.reshape(batch_alpha, alpha_shape)
+                batch_beta = tf.reshape(batch_beta, alpha_shape)
+
+                batch_interactions = self.accumulation_function(batch_input,
+                                                                batch_baseline,
+                                                                batch_alphas=(batch_alpha,
+                                                                              batch_beta),
+                                                                output_index=step_output,
+                                                                second_order=True,
+                                                                interaction_index=index_list)
+                return tf.reduce_sum(batch_interactions, axis=0)
+
+            input_spec = tf.TensorSpec((None,) + input_shape, dtype)
+            alpha_spec = tf.TensorSpec((None,), dtype)
+            input_signature = [input_spec,
+                               input_spec,
+                               tf.TensorSpec((None,), tf.int32)]
+            if num_classes is not None:
+                input_signature.append(tf.TensorSpec((num_classes,), dtype))
+            input_signature += [alpha_spec, alpha_spec]
+            self._interaction_steps[key] = self._compile(interaction_step,
+                                                         input_signature)
+        return self._interaction_steps[key]
+
+    def _single_interaction(self, current_input, baseline,
+                            current_baseline_indices, current_alphas,
+                            num_samples, batch_size, output_index,
                             interaction_index):
         """
         A helper function to compute path
@@ -408,46 +1293,60 @@ class PathExplainerTF(Explainer):
 
         Args:
             current_input: A single sample. Assumes that
-                           it is of shape (...) where ...
+                           it is of shape (1, ...) where ...
                            represents the input dimensionality
             baseline: A tensor representing the baseline input.
+            current_baseline_indices: Which baselines to interpolate from
             current_alphas: Which alphas to use when interpolating
             num_samples: The number of samples to draw
             batch_size: Batch size to input to the model
-            use_expectation: Whether or not to sample the baseline
-            output_index: Whether or not to index into a given class
+            output_index: None, a one-hot mask of shape (num_classes,)
+                          selecting the class to explain, or an integer
+                          for an accumulation_function that does not
+                          accept output masks
             interaction_index: The index to take the interactions with respect to.
         """
-        current_input = np.expand_dims(current_input, axis=0)
         current_alpha, current_beta = current_alphas
-        current_alpha = tf.reshape(current_alpha, (num_samples,) + \
-                                    (1,) * (len(current_input.shape) - 1))
-        current_beta = tf.reshape(current_beta, (num_samples,) + \
-                                 (1,) * (len(current_input.shape) - 1))
-        attribution_array = []
+        output_mask = None
+        if tf.is_tensor(output_index):
+            output_mask = output_index
+            output_index = None
+        interaction_step = self._interaction_step(current_input.shape[1:],
+                                                  current_input.dtype,
+                                                  None if output_mask is None else output_mask.shape[0],
+                                                  interaction_index,
+                                                  output_index=output_index)
+        interactions = None
         for j in range(0, num_samples, batch_size):
-            number_to_draw = min(batch_size, num_samples - j)
-
-            batch_baseline = self._sample_baseline(current_baseline,
-                                                   number_to_draw,
-                                                   use_expectation)
-            batch_alpha = current_alpha[j:min(j + batch_size, num_samples)]
-            batch_beta = current_beta[j:min(j + batch_size, num_samples)]
-
-            reps = np.ones(len(current_input.shape)).astype(int)
-            reps[0] = number_to_draw
-            batch_input = tf.convert_to_tensor(np.tile(current_input, reps))
-
-            batch_attributions = self.accumulation_function(batch_input,
-                                                            batch_baseline,
-                                                            batch_alphas=(batch_alpha, batch_beta),
-                                                            output_index=output_index,
-                                                            second_order=True,
-                                                            interaction_index=interaction_index)
-            attribution_array.append(batch_attributions)
-        attribution_array = np.concatenate(attribution_array, axis=0)
-        attributions = np.mean(attribution_array, axis=0)
-        return attributions
+            step_args = [current_input,
+                         baseline,
+                         current_baseline_indices[j:j + batch_size]]
+            if output_mask is not None:
+                step_args.append(output_mask)
+            step_args.append(current_alpha[j:j + batch_size])
+            step_args.append(current_beta[j:j + batch_size])
+            batch_attributions = interaction_step(*step_args)
+            if interactions is None:
+                interactions = batch_attributions
+            else:
+                interactions = interactions + batch_attributions
+        interactions = interactions / num_samples
+        return interactions
+
+    def _check_baseline(self, inputs, baseline, use_expectation):
+        """
+        Internal helper function that checks that, when
+        use_expectation is False, there is either a single
+        baseline or one baseline per input. Otherwise the baseline
+        indices would point past the end of the baseline, which
+        is clamped or zero-filled on device rather than raising.
+        """
+        if not use_expectation and \
+           baseline.shape[0] != 1 and baseline.shape[0] != inputs.shape[0]:
+            raise ValueError('When use_expectation is False, baseline ' + \
+                             'should be of shape (1, ...) or ' + \
+                             '(num_inputs, ...), but got {} baselines '.format(baseline.shape[0]) + \
+                             'for {} inputs!'.format(inputs.shape[0]))
 
     def _clean_index(self, interaction_index):
         """
@@ -479,6 +1378,8 @@ class PathExplainerTF(Explainer):
                          expectation or integral.
             use_expectation: If True, this samples baselines and interpolation
                              constants uniformly at random (expected gradients).
+                             The samples are drawn with TensorFlow, so call
+                             tf.random.set_seed for reproducible results.
                              If False, then this assumes num_refs=1 in which
                              case it uses the same baseline for all inputs,
                              or num_refs=batch_size, in which case it uses
@@ -505,55 +1406,81 @@ class PathExplainerTF(Explainer):
                                                                       True)
 
         interaction_index = self._clean_index(interaction_index)
+        self._check_baseline(inputs, baseline, use_expectation)
 
-        input_iterable = enumerate(inputs)
-        if verbose:
-            input_iterable = enumerate(tqdm(inputs))
+        num_inputs = inputs.shape[0]
+        inputs = tf.convert_to_tensor(inputs)
+        dtype = inputs.dtype
+        baseline = tf.cast(baseline, dtype)
+        # Classes are selected with one-hot masks so that every class
+        # shares one graph, or with integers for an accumulation_function
+        # that does not accept output masks.
+        output_masks = None
+        if is_multi_output:
+            if output_indices is None:
+                output_masks = np.arange(num_classes)
+            elif isinstance(output_indices, int):
+                output_masks = np.full(num_inputs, output_indices)
+            else:
+                output_masks = np.asarray(output_indices)
+            if self._accepts_output_masks():
+                output_masks = tf.one_hot(output_masks, num_classes, dtype=dtype)
+        alphas, betas = self._sample_alphas(num_inputs, num_samples,
+                                            use_expectation,
+                                            use_product=True,
+                                            dtype=dtype)
+        baseline_indices = self._sample_baseline_indices(baseline.shape[0],
+                                                         num_inputs,
+                                                         num_samples,
+                                                         use_expectation)
 
-        for i, current_input in input_iterable:
-            current_alphas = self._sample_alphas(num_samples,
-                                                 use_expectation,
-                                                 use_product=True)
+        # Results are written into a device-side variable and
+        # copied to the host once, after every input is done.
+        device_interactions = tf.Variable(tf.zeros(interactions.shape, dtype=dtype))
 
-            if not use_expectation and baseline.shape[0] > 1:
-                current_baseline = np.expand_dims(baseline[i], axis=0)
-            else:
-                current_baseline = baseline
+        # Iterate over indices and slice, rather than iterating over
+        # the tensor itself, which would copy each row to a new tensor.
+        input_indices = range(num_inputs)
+        if verbose:
+            input_indices = tqdm(input_indices)
+
+        for i in input_indices:
+            current_input = inputs[i:i + 1]
+            current_alphas = (alphas[i], betas[i])
+            current_baseline_indices = baseline_indices[i]
 
             if is_multi_output:
                 if output_indices is not None:
-                    if isinstance(output_indices, int):
-                        output_index = output_indices
-                    else:
-                        output_index = output_indices[i]
                     current_interactions = self._single_interaction(current_input,
-                                                                    current_baseline,
+                                                                    baseline,
+                                                                    current_baseline_indices,
                                                                     current_alphas,
                                                                     num_samples,
                                                                     batch_size,
-                                                                    use_expectation,
-                                                                    output_index,
+                                                                    output_masks[i],
                                                                     interaction_index)
-                    interactions[i] = current_interactions
+                    device_interactions[i].assign(current_interactions)
                 else:
                     for output_index in range(num_classes):
                         current_interactions = self._single_interaction(current_input,
-                                                                        current_baseline,
+                                                                        baseline,
+                                                                        current_baseline_indices,
                                                                         current_alphas,
                                                                         num_samples,
                                                                         batch_size,
-                                                                        use_expectation,
-                                                                        output_index,
+                                                                        output_masks[output_index],
                                                                         interaction_index)
-                        interactions[output_index, i] = current_interactions
+                        device_interactions[output_index, i].assign(current_interactions)
             else:
                 current_interactions = self._single_interaction(current_input,
-                                                                current_baseline,
+                                                                baseline,
+                                                                current_baseline_indices,
                                                                 current_alphas,
                                                                 num_samples,
                                                                 batch_size,
-                                                                use_expectation,
                                                                 None,
                                                                 interaction_index)
-                interactions[i] = current_interactions
+                device_interactions[i].assign(current_interactions)
+
+        interactions[...] = device_interactions.numpy()
         return interactions